@@ -1,22 +1,28 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
-import whisper
-from pydub import AudioSegment
-import tempfile
+from faster_whisper.audio import pad_or_trim
+from faster_whisper.tokenizer import Tokenizer
+from whisper_common import SAMPLE_RATE, AudioUploadError, decode_upload, load_model
+import numpy as np
 import os
-import uuid
 import re
+import json
 import logging
 import threading
 import time
+import queue
+import sched
 import asyncio
 import edge_tts
 import atexit
-from datetime import datetime, timedelta
-from xml.etree import ElementTree
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from datetime import datetime
+from xml.parsers import expat
 
 # --- App Setup ---
 app = Flask(__name__)
+# Read by flask_cors and by RateLimitMiddleware, which answers before flask_cors runs
+app.config["CORS_ORIGINS"] = "*"
 CORS(app)
 
 # --- Logging ---
@@ -24,7 +30,13 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # --- Whisper Model ---
-whisper_model = whisper.load_model("base")
+whisper_model = load_model()
+TRANSCRIBE_TIMEOUT = 120
+# Uploads arriving within MAX_WAIT_MS of each other share one forward pass, up to MAX_BATCH
+MAX_BATCH = 8
+MAX_WAIT_MS = 20
+WINDOW_SAMPLES = 30 * SAMPLE_RATE
+transcribe_queue = queue.Queue()
 
 # --- TTS Config ---
 TEMP_DIR = "temp_audio"
@@ -32,9 +44,61 @@ os.makedirs(TEMP_DIR, exist_ok=True)
 MAX_TEXT_LENGTH = 5000
 CLEANUP_INTERVAL = 300
 FILE_RETENTION_TIME = 600
-request_tracker = {}
+# Single scheduler for temp_audio housekeeping, drained by one background thread
+cleanup_sched = sched.scheduler(time.monotonic, time.sleep)
+SSML_TAG_RE = re.compile(r'<[^>]+>')
+SPEAK_TAG_RE = re.compile(r'<speak[^>]*>', re.IGNORECASE)
+ROBOTIC_TABLE = str.maketrans({'!': '.', '?': '.'})
+VALID_VOICES = [
+    "en-US-SteffanNeural", "en-US-RogerMultilingualNeural",
+    "en-US-ChristopherNeural", "en-US-JennyNeural"
+]
+# /voices never changes, so serialize it once
+VOICES_BODY = json.dumps({"voices": VALID_VOICES}).encode()
+RATE_LIMIT = 60
+RATE_WINDOW = 3600
+rate_buckets = {}
 request_lock = threading.Lock()
 
+# --- Shared Rate Limit (Redis) ---
+# Set REDIS_URL to share limits across workers/replicas; otherwise buckets stay in-process
+REDIS_URL = os.environ.get("REDIS_URL")
+RATE_LIMIT_LUA = """
+local cap = tonumber(ARGV[2])
+local window = tonumber(ARGV[3])
+local now = tonumber(ARGV[1])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or cap
+local last = tonumber(bucket[2]) or now
+tokens = math.min(cap, tokens + math.max(0, now - last) * cap / window)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], window)
+return allowed
+"""
+if REDIS_URL:
+    import redis
+    # Short timeouts so an unreachable Redis falls back to the local bucket quickly
+    redis_client = redis.Redis.from_url(REDIS_URL, socket_connect_timeout=0.1, socket_timeout=0.1)
+    redis_rate_limit = redis_client.register_script(RATE_LIMIT_LUA)
+else:
+    redis_rate_limit = None
+# After a Redis error, skip it for REDIS_RETRY_AFTER seconds and warn once per outage
+REDIS_RETRY_AFTER = 30
+redis_retry_at = 0.0
+redis_down = False
+redis_state_lock = threading.Lock()
+
+# --- Async Loop ---
+# One long-lived loop for edge-tts jobs instead of a fresh asyncio.run() per request
+_LOOP = asyncio.new_event_loop()
+threading.Thread(target=_LOOP.run_forever, daemon=True).start()
+TTS_TIMEOUT = 60
+
 # --- Whisper Endpoint ---
 @app.route("/upload_audio", methods=["POST"])
 def upload_audio():
@@ -44,94 +108,207 @@ def upload_audio():
     audio_file = request.files['audio']
 
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as temp_input:
-            audio_file.save(temp_input.name)
-            temp_input_path = temp_input.name
+        audio = decode_upload(audio_file)
 
-        audio_segment = AudioSegment.from_file(temp_input_path)
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp_wav:
-            audio_segment.export(temp_wav.name, format="wav")
-            temp_wav_path = temp_wav.name
+        fut = Future()
+        transcribe_queue.put((audio, fut))
+        try:
+            text = fut.result(timeout=TRANSCRIBE_TIMEOUT)
+        except FutureTimeout:
+            fut.cancel()
+            return jsonify({"status": "error", "message": "Transcription timed out"}), 503
+        return jsonify({"status": "success", "text": text})
 
-        result = whisper_model.transcribe(temp_wav_path)
-        return jsonify({"status": "success", "text": result["text"]})
+    except AudioUploadError as e:
+        return jsonify({"status": "error", "message": str(e)}), e.status
 
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
-    finally:
-        for path in [temp_input_path, 'temp_wav_path']:
-            if path in locals() and os.path.exists(locals()[path]):
-                try: os.remove(locals()[path])
-                except: pass
+def next_batch():
+    # Block for one upload, then gather whatever else arrives within MAX_WAIT_MS
+    batch = [transcribe_queue.get()]
+    deadline = time.monotonic() + MAX_WAIT_MS / 1000
+    while len(batch) < MAX_BATCH:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(transcribe_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return [(audio, fut) for audio, fut in batch if fut.set_running_or_notify_cancel()]
+
+def transcribe_batch(clips):
+    # Whisper pads every clip to one 30 s mel window, so clips that fit stack into a
+    # single (N, n_mels, 3000) batch for one encoder pass, language detection and decode
+    features = np.stack([
+        pad_or_trim(whisper_model.feature_extractor(clip)[..., :-1]) for clip in clips
+    ])
+    encoder_output = whisper_model.encode(features)
+    multilingual = whisper_model.model.is_multilingual
+    if multilingual:
+        languages = [langs[0][0][2:-2] for langs in whisper_model.model.detect_language(encoder_output)]
+    else:
+        languages = [None] * len(clips)
+    tokenizers = [
+        Tokenizer(whisper_model.hf_tokenizer, multilingual, task="transcribe", language=language)
+        for language in languages
+    ]
+    prompts = [whisper_model.get_prompt(tokenizer, [], without_timestamps=True) for tokenizer in tokenizers]
+    results = whisper_model.model.generate(
+        encoder_output, prompts, beam_size=1, max_length=whisper_model.max_length, suppress_blank=True
+    )
+    return [tokenizer.decode(result.sequences_ids[0]) for tokenizer, result in zip(tokenizers, results)]
+
+def transcription_worker():
+    # Single owner of the model: concurrent uploads are drained and transcribed together
+    while True:
+        batch = next_batch()
+        clips = [(audio, fut) for audio, fut in batch if len(audio) <= WINDOW_SAMPLES]
+        if clips:
+            try:
+                texts = transcribe_batch([audio for audio, _ in clips])
+            except Exception as e:
+                for _, fut in clips:
+                    fut.set_exception(e)
+            else:
+                for (_, fut), text in zip(clips, texts):
+                    fut.set_result(text)
+        # Recordings longer than one window need the sequential windowed decode
+        for audio, fut in batch:
+            if len(audio) <= WINDOW_SAMPLES:
+                continue
+            try:
+                segments, _ = whisper_model.transcribe(audio, beam_size=1)
+                fut.set_result("".join(s.text for s in segments))
+            except Exception as e:
+                fut.set_exception(e)
 
 # --- TTS Helper Functions ---
 def is_valid_ssml(text):
+    if not SPEAK_TAG_RE.search(text):
+        text = f"<speak>{text}</speak>"
+    # Well-formedness only, so parse with expat directly instead of building a tree
+    parser = expat.ParserCreate()
     try:
-        if not re.search(r'<speak[^>]*>', text, re.IGNORECASE):
-            text = f"<speak>{text}</speak>"
-        ElementTree.fromstring(text)
+        parser.Parse(text, True)
         return True
-    except ElementTree.ParseError:
+    except expat.ExpatError:
         return False
 
 def rate_limit_check(ip):
-    current_time = datetime.now()
+    global redis_retry_at, redis_down
+    if redis_rate_limit is not None and time.monotonic() >= redis_retry_at:
+        try:
+            # Wall clock, not monotonic: the timestamp is compared across hosts
+            allowed = bool(redis_rate_limit(keys=[f"rl:{ip}"], args=[time.time(), RATE_LIMIT, RATE_WINDOW]))
+        except redis.RedisError as e:
+            with redis_state_lock:
+                redis_retry_at = time.monotonic() + REDIS_RETRY_AFTER
+                if not redis_down:
+                    redis_down = True
+                    logger.warning(f"Redis rate limit unavailable, using local bucket: {e}")
+        else:
+            if redis_down:
+                with redis_state_lock:
+                    if redis_down:
+                        redis_down = False
+                        logger.info("Redis rate limit available again")
+            return allowed
+    return local_rate_limit_check(ip)
+
+def local_rate_limit_check(ip):
+    # Token bucket: RATE_LIMIT tokens per RATE_WINDOW seconds, stored as (tokens, last_refill)
+    now = time.monotonic()
     with request_lock:
-        request_tracker[ip] = [
-            t for t in request_tracker.get(ip, [])
-            if current_time - t < timedelta(hours=1)
-        ]
-        if len(request_tracker[ip]) >= 60:
+        tokens, last = rate_buckets.get(ip, (float(RATE_LIMIT), now))
+        tokens = min(float(RATE_LIMIT), tokens + (now - last) * RATE_LIMIT / RATE_WINDOW)
+        if tokens < 1:
+            rate_buckets[ip] = (tokens, now)
             return False
-        request_tracker[ip].append(current_time)
+        rate_buckets[ip] = (tokens - 1, now)
         return True
 
-async def generate_audio(text, voice, path, rate=None, pitch=None, volume=None):
+class RateLimitMiddleware:
+    # Rejects over-limit /speak calls before Flask routes the request or parses JSON
+    body = b'{"error": "Rate limit exceeded"}'
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') == "/speak" and environ.get('REQUEST_METHOD') == "POST":
+            ip = environ.get('HTTP_X_FORWARDED_FOR', environ.get('REMOTE_ADDR'))
+            try:
+                allowed = rate_limit_check(ip)
+            except Exception as e:
+                # Outside Flask's error handlers here, so fail open rather than return a bare 500
+                logger.error(f"Rate limit check failed: {e}")
+                allowed = True
+            if not allowed:
+                start_response("429 Too Many Requests", [
+                    ("Content-Type", "application/json"),
+                    ("Content-Length", str(len(self.body))),
+                ] + self.cors_headers(environ))
+                return [self.body]
+        return self.app(environ, start_response)
+
+    def cors_headers(self, environ):
+        # flask_cors never sees this response, so mirror its origin check from the shared config
+        origins = app.config["CORS_ORIGINS"]
+        if origins == "*":
+            return [("Access-Control-Allow-Origin", "*")]
+        origin = environ.get('HTTP_ORIGIN')
+        allowed = [origins] if isinstance(origins, str) else origins
+        if origin and origin in allowed:
+            return [("Access-Control-Allow-Origin", origin), ("Vary", "Origin")]
+        return []
+
+app.wsgi_app = RateLimitMiddleware(app.wsgi_app)
+
+async def generate_audio(text, voice, rate=None, pitch=None, volume=None):
+    communicate = edge_tts.Communicate(
+        text=text,
+        voice=voice,
+        rate=rate or "+0%",
+        pitch=pitch or "+0Hz",
+        volume=volume or "+0%"
+    )
+    async for chunk in communicate.stream():
+        if chunk["type"] == "audio":
+            yield chunk["data"]
+
+async def pump_audio(chunks, out):
+    # Feed audio bytes into a thread-safe queue; ends with None, or the exception on failure
     try:
-        communicate = edge_tts.Communicate(
-            text=text,
-            voice=voice,
-            rate=rate or "+0%",
-            pitch=pitch or "+0Hz",
-            volume=volume or "+0%"
-        )
-        with open(path, "wb") as f:
-            async for chunk in communicate.stream():
-                if chunk["type"] == "audio":
-                    f.write(chunk["data"])
-        return True
+        async for data in chunks:
+            out.put(data)
     except Exception as e:
         logger.error(f"TTS generation error: {e}")
-        if os.path.exists(path):
-            try: os.remove(path)
-            except: pass
-        return False
+        out.put(e)
+        return
+    out.put(None)
 
 def cleanup_old_files():
     now = time.time()
-    for f in os.listdir(TEMP_DIR):
-        fp = os.path.join(TEMP_DIR, f)
-        if os.path.isfile(fp) and now - os.path.getctime(fp) > FILE_RETENTION_TIME:
-            try:
-                os.remove(fp)
-                logger.info(f"Deleted old file: {fp}")
-            except Exception as e:
-                logger.warning(f"Cleanup error: {e}")
-
-def cleanup_thread():
-    while True:
-        time.sleep(CLEANUP_INTERVAL)
-        cleanup_old_files()
+    with os.scandir(TEMP_DIR) as entries:
+        for entry in entries:
+            if entry.is_file() and now - entry.stat().st_ctime > FILE_RETENTION_TIME:
+                try:
+                    os.remove(entry.path)
+                    logger.info(f"Deleted old file: {entry.path}")
+                except Exception as e:
+                    logger.warning(f"Cleanup error: {e}")
+
+def scheduled_cleanup():
+    cleanup_old_files()
+    cleanup_sched.enter(CLEANUP_INTERVAL, 1, scheduled_cleanup)
 
 # --- Routes ---
 
 @app.route("/speak", methods=["POST"])
 def speak():
-    ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr)
-    if not rate_limit_check(ip):
-        return jsonify({"error": "Rate limit exceeded"}), 429
-
     try:
         data = request.get_json(force=True)
         text = data.get("text", "").strip()
@@ -146,12 +323,8 @@ def speak():
         if len(text) > MAX_TEXT_LENGTH:
             return jsonify({"error": "Text too long"}), 400
 
-        valid_voices = [
-            "en-US-SteffanNeural", "en-US-RogerMultilingualNeural",
-            "en-US-ChristopherNeural", "en-US-JennyNeural"
-        ]
-        if voice not in valid_voices:
-            return jsonify({"error": "Invalid voice", "valid_voices": valid_voices}), 400
+        if voice not in VALID_VOICES:
+            return jsonify({"error": "Invalid voice", "valid_voices": VALID_VOICES}), 400
 
         # Apply mappings
         rate_map = {"x-slow": "-50%", "slow": "-25%", "medium": "+0%", "fast": "+25%", "x-fast": "+50%"}
@@ -165,9 +338,10 @@ def speak():
             rate = "+20%"
             pitch = "-20Hz"
             volume = "+10%"
-            text = re.sub(r'[!?]', '.', text).replace(". ", ". ")
+            text = text.translate(ROBOTIC_TABLE)
 
-        has_ssml = bool(re.search(r'<[^>]+>', text))
+        # Plain text is the common case; a substring check skips the regex entirely
+        has_ssml = '<' in text and SSML_TAG_RE.search(text) is not None
         if has_ssml:
             if not is_valid_ssml(text):
                 return jsonify({"error": "Invalid SSML"}), 400
@@ -176,24 +350,36 @@ def speak():
         else:
             final_text = text
 
-        filename = f"tts_{uuid.uuid4()}.mp3"
-        filepath = os.path.join(TEMP_DIR, filename)
-
-        success = asyncio.run(generate_audio(final_text, voice, filepath, rate, pitch, volume))
-        if not success:
+        chunks = queue.Queue()
+        fut = asyncio.run_coroutine_threadsafe(
+            pump_audio(generate_audio(final_text, voice, rate, pitch, volume), chunks), _LOOP
+        )
+        # Wait for the first chunk so failures before any audio still return a JSON error
+        try:
+            first = chunks.get(timeout=TTS_TIMEOUT)
+        except queue.Empty:
+            fut.cancel()
+            logger.error("TTS generation timed out")
+            first = None
+        if not isinstance(first, bytes):
             return jsonify({"error": "TTS failed"}), 500
 
-        response = send_file(filepath, mimetype="audio/mpeg", as_attachment=False)
+        def stream():
+            yield first
+            while True:
+                try:
+                    data = chunks.get(timeout=TTS_TIMEOUT)
+                except queue.Empty:
+                    logger.error("TTS generation timed out mid-stream")
+                    return
+                if not isinstance(data, bytes):
+                    return
+                yield data
+
+        response = Response(stream(), mimetype="audio/mpeg")
         response.headers["Cache-Control"] = "no-cache"
-        response.headers["Content-Length"] = str(os.path.getsize(filepath))
-
-        def delayed_cleanup():
-            time.sleep(30)
-            try:
-                if os.path.exists(filepath): os.remove(filepath)
-            except: pass
-
-        threading.Thread(target=delayed_cleanup, daemon=True).start()
+        # Runs even if the client disconnects before the body is iterated
+        response.call_on_close(fut.cancel)
         return response
 
     except Exception as e:
@@ -202,19 +388,16 @@ def speak():
 
 @app.route("/voices", methods=["GET"])
 def voices():
-    return jsonify({
-        "voices": [
-            "en-US-SteffanNeural", "en-US-RogerMultilingualNeural",
-            "en-US-ChristopherNeural", "en-US-JennyNeural"
-        ]
-    })
+    return Response(VOICES_BODY, mimetype="application/json")
 
 @app.route("/health", methods=["GET"])
 def health():
+    with os.scandir(TEMP_DIR) as entries:
+        temp_files = sum(1 for _ in entries)
     return jsonify({
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
-        "temp_files": len(os.listdir(TEMP_DIR))
+        "temp_files": temp_files
     })
 
 @app.errorhandler(Exception)
@@ -224,13 +407,20 @@ def global_error(e):
 
 @atexit.register
 def exit_cleanup():
-    for f in os.listdir(TEMP_DIR):
+    for event in cleanup_sched.queue:
         try:
-            os.remove(os.path.join(TEMP_DIR, f))
-        except: pass
+            cleanup_sched.cancel(event)
+        except ValueError: pass
+    with os.scandir(TEMP_DIR) as entries:
+        for entry in entries:
+            try:
+                os.remove(entry.path)
+            except: pass
 
-# --- Background Thread ---
-threading.Thread(target=cleanup_thread, daemon=True).start()
+# --- Background Threads ---
+cleanup_sched.enter(CLEANUP_INTERVAL, 1, scheduled_cleanup)
+threading.Thread(target=cleanup_sched.run, daemon=True).start()
+threading.Thread(target=transcription_worker, daemon=True).start()
 
 # --- Start ---
 if __name__ == "__main__":
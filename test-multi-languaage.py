@@ -1,15 +1,41 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import whisper
-from pydub import AudioSegment
-import tempfile
-import os
+from whisper_common import AudioUploadError, decode_upload, load_model
 
 app = Flask(__name__)
 CORS(app)
 
-# Load Whisper model once on startup
-model = whisper.load_model("base")
+model = load_model()
+
+# faster-whisper only takes language codes; the frontend sends Whisper's language names
+LANGUAGES = {
+    "en": "english", "zh": "chinese", "de": "german", "es": "spanish", "ru": "russian",
+    "ko": "korean", "fr": "french", "ja": "japanese", "pt": "portuguese", "tr": "turkish",
+    "pl": "polish", "ca": "catalan", "nl": "dutch", "ar": "arabic", "sv": "swedish",
+    "it": "italian", "id": "indonesian", "hi": "hindi", "fi": "finnish", "vi": "vietnamese",
+    "he": "hebrew", "uk": "ukrainian", "el": "greek", "ms": "malay", "cs": "czech",
+    "ro": "romanian", "da": "danish", "hu": "hungarian", "ta": "tamil", "no": "norwegian",
+    "th": "thai", "ur": "urdu", "hr": "croatian", "bg": "bulgarian", "lt": "lithuanian",
+    "la": "latin", "mi": "maori", "ml": "malayalam", "cy": "welsh", "sk": "slovak",
+    "te": "telugu", "fa": "persian", "lv": "latvian", "bn": "bengali", "sr": "serbian",
+    "az": "azerbaijani", "sl": "slovenian", "kn": "kannada", "et": "estonian", "mk": "macedonian",
+    "br": "breton", "eu": "basque", "is": "icelandic", "hy": "armenian", "ne": "nepali",
+    "mn": "mongolian", "bs": "bosnian", "kk": "kazakh", "sq": "albanian", "sw": "swahili",
+    "gl": "galician", "mr": "marathi", "pa": "punjabi", "si": "sinhala", "km": "khmer",
+    "sn": "shona", "yo": "yoruba", "so": "somali", "af": "afrikaans", "oc": "occitan",
+    "ka": "georgian", "be": "belarusian", "tg": "tajik", "sd": "sindhi", "gu": "gujarati",
+    "am": "amharic", "yi": "yiddish", "lo": "lao", "uz": "uzbek", "fo": "faroese",
+    "ht": "haitian creole", "ps": "pashto", "tk": "turkmen", "nn": "nynorsk", "mt": "maltese",
+    "sa": "sanskrit", "lb": "luxembourgish", "my": "myanmar", "bo": "tibetan", "tl": "tagalog",
+    "mg": "malagasy", "as": "assamese", "tt": "tatar", "haw": "hawaiian", "ln": "lingala",
+    "ha": "hausa", "ba": "bashkir", "jw": "javanese", "su": "sundanese", "yue": "cantonese",
+}
+TO_LANGUAGE_CODE = {
+    **{name: code for code, name in LANGUAGES.items()},
+    "burmese": "my", "valencian": "ca", "flemish": "nl", "haitian": "ht",
+    "letzeburgesch": "lb", "pushto": "ps", "panjabi": "pa", "moldavian": "ro",
+    "moldovan": "ro", "sinhalese": "si", "castilian": "es", "mandarin": "zh",
+}
 
 @app.route("/upload_audio", methods=["POST"])
 def upload_audio():
@@ -18,39 +44,30 @@ def upload_audio():
 
     audio_file = request.files['audio']
     user_lang = request.form.get('language', '').strip().lower() or None  # Optional language override
+    if user_lang:
+        user_lang = TO_LANGUAGE_CODE.get(user_lang, user_lang)
+        if user_lang not in LANGUAGES:
+            return jsonify({"status": "error", "message": f"Unsupported language: {user_lang}"}), 400
 
     try:
-        # Step 1: Save input audio temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as temp_input:
-            audio_file.save(temp_input.name)
-            temp_input_path = temp_input.name
-
-        # Step 2: Convert to WAV
-        audio_segment = AudioSegment.from_file(temp_input_path)
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp_wav:
-            audio_segment.export(temp_wav.name, format="wav")
-            temp_wav_path = temp_wav.name
+        # Step 1: Decode input audio to 16 kHz mono PCM in memory
+        audio = decode_upload(audio_file)
 
-        # Step 3: Transcribe
-        result = model.transcribe(temp_wav_path, language=user_lang)
+        # Step 2: Transcribe
+        segments, info = model.transcribe(audio, language=user_lang, beam_size=1)
+        text = "".join(s.text for s in segments)
 
         return jsonify({
             "status": "success",
-            "language_used": result.get("language", user_lang or "undetected"),
-            "text": result.get("text", "")
+            "language_used": info.language or user_lang or "undetected",
+            "text": text
         })
 
+    except AudioUploadError as e:
+        return jsonify({"status": "error", "message": str(e)}), e.status
+
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
-    finally:
-        # Step 4: Clean up
-        if os.path.exists(temp_input_path):
-            try: os.remove(temp_input_path)
-            except: pass
-        if 'temp_wav_path' in locals() and os.path.exists(temp_wav_path):
-            try: os.remove(temp_wav_path)
-            except: pass
-
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
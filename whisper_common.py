@@ -0,0 +1,42 @@
+from faster_whisper import WhisperModel
+import numpy as np
+import subprocess
+import os
+
+SAMPLE_RATE = 16000
+MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+FFMPEG_DECODE = [
+    "ffmpeg", "-loglevel", "error", "-i", "pipe:0",
+    "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1"
+]
+
+# --- Whisper Model ---
+def load_model(size="base"):
+    # Split cores between gunicorn workers instead of each one claiming all of them
+    workers = max(1, int(os.environ.get("GUNICORN_WORKERS", "1")))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    model = WhisperModel(size, device="cpu", compute_type="int8", cpu_threads=threads)
+    # Warm up once so the first real request doesn't pay for allocation and kernel setup
+    list(model.transcribe(np.zeros(SAMPLE_RATE, dtype=np.float32), beam_size=1)[0])
+    return model
+
+# --- Audio Decoding ---
+class AudioUploadError(Exception):
+    # Problem with the uploaded audio itself; status is the HTTP code to answer with
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def decode_upload(audio_file):
+    # Decode an uploaded file straight to 16 kHz mono float32 PCM through an ffmpeg pipe
+    data = audio_file.read(MAX_UPLOAD_BYTES + 1)
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise AudioUploadError(f"Audio file too large (max {MAX_UPLOAD_BYTES // (1024 * 1024)} MB)", 413)
+    try:
+        proc = subprocess.run(FFMPEG_DECODE, input=data, capture_output=True, check=True)
+    except subprocess.CalledProcessError as e:
+        message = e.stderr.decode(errors="replace").strip()
+        raise AudioUploadError(f"Audio decode failed: {message}") from e
+    if not proc.stdout:
+        raise AudioUploadError("Audio contains no samples")
+    return np.frombuffer(proc.stdout, np.int16).astype(np.float32) / 32768.0